@@ -0,0 +1,5 @@
+# Started as "python src" rather than "python src/main.py": multiprocessing workers
+# (thumbnail rendering) then don't re-run the whole bot module on startup.
+import main
+
+main.run()
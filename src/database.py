@@ -1,15 +1,42 @@
+import re
 import sqlite3
+import threading
 
-def create_connection():
+DB_PATH = "/app/data/db/memes.db"
+
+# sqlite3 caches prepared statements per connection, keyed by SQL text, so
+# every caller of the same query must use the exact same string.
+INSERT_MEME_SQL = """
+    INSERT INTO memes(content_hash, file_path, tags, width, height, telegram_unique_id)
+    VALUES(?,?,?,?,?,?)
+"""
+INSERT_MEME_IF_NEW_SQL = INSERT_MEME_SQL.replace("INSERT", "INSERT OR IGNORE", 1)
+
+# Runs of letters/digits: the only text the FTS tokenizer indexes, so the only
+# text worth putting in a MATCH expression
+_FTS_TOKEN_RE = re.compile(r"[^\W_]+")
+
+# Database files whose schema has already been created/migrated by this process
+_schema_ready = set()
+_schema_lock = threading.Lock()
+
+
+def create_connection(db_path=DB_PATH):
     """ create a database connection to the SQLite database
         and ensure the table exists.
+    :param db_path: path to the database file (or ":memory:")
     :return: Connection object or None
     """
     conn = None
     try:
-        conn = sqlite3.connect("/app/data/db/memes.db", check_same_thread=False)
-        # Ensure the table is created and migrated every time we connect
-        create_table(conn)
+        conn = sqlite3.connect(db_path, check_same_thread=False, cached_statements=256)
+        configure_connection(conn, db_path)
+        # Create and migrate the schema once per process; every :memory: database is fresh
+        with _schema_lock:
+            if db_path not in _schema_ready:
+                create_table(conn)
+                if db_path != ":memory:":
+                    _schema_ready.add(db_path)
         return conn
     except sqlite3.Error as e:
         print(e)
@@ -17,6 +44,29 @@ def create_connection():
     return conn
 
 
+def configure_connection(conn, db_path=DB_PATH):
+    """ tune the connection for a single-process bot workload.
+    WAL lets readers proceed while a write is committing and, together with
+    synchronous=NORMAL, turns each commit into a single append to the log.
+    :param conn: the Connection object
+    :param db_path: path the connection was opened with
+    """
+    # The bot is the only process using the file: hold the lock for the connection's
+    # lifetime instead of re-acquiring it per transaction. Set before entering WAL so
+    # the WAL index lives in heap memory rather than a -shm file.
+    conn.execute("PRAGMA locking_mode=EXCLUSIVE")
+    # WAL is meaningless (and unsupported) for in-memory databases
+    if db_path != ":memory:":
+        conn.execute("PRAGMA journal_mode=WAL")
+    conn.executescript("""
+        PRAGMA synchronous=NORMAL;
+        PRAGMA temp_store=MEMORY;
+        PRAGMA cache_size=-20000;
+        PRAGMA mmap_size=268435456;
+        PRAGMA busy_timeout=5000;
+    """)
+
+
 def create_table(conn):
     """ create a table and migrate schema to use content_hash """
     try:
@@ -40,39 +90,165 @@ def create_table(conn):
         elif 'content_hash' not in columns:
             # Add the column if it doesn't exist at all
             c.execute("ALTER TABLE memes ADD COLUMN content_hash TEXT;")
+
+        # Image dimensions, stored so inline queries don't have to open the files
+        if 'width' not in columns:
+            c.execute("ALTER TABLE memes ADD COLUMN width INTEGER;")
+        if 'height' not in columns:
+            c.execute("ALTER TABLE memes ADD COLUMN height INTEGER;")
+
+        # Telegram's file_unique_id of uploaded photos, to skip re-downloading known ones.
+        # (Not named file_unique_id: that legacy column is migrated to content_hash above.)
+        if 'telegram_unique_id' not in columns:
+            c.execute("ALTER TABLE memes ADD COLUMN telegram_unique_id TEXT;")
+        c.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_telegram_unique_id ON memes (telegram_unique_id);")
         
         # Create a unique index to enforce uniqueness on the new column
         c.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_content_hash ON memes (content_hash);")
 
+        # Full-text index over tags, kept in sync with memes by triggers
+        c.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'memes_fts';")
+        fts_exists = c.fetchone() is not None
+        c.executescript("""
+            CREATE VIRTUAL TABLE IF NOT EXISTS memes_fts USING fts5(
+                tags,
+                content='memes',
+                content_rowid='id',
+                tokenize='unicode61 remove_diacritics 0'
+            );
+            CREATE TRIGGER IF NOT EXISTS memes_ai AFTER INSERT ON memes BEGIN
+                INSERT INTO memes_fts(rowid, tags) VALUES (new.id, new.tags);
+            END;
+            CREATE TRIGGER IF NOT EXISTS memes_ad AFTER DELETE ON memes BEGIN
+                INSERT INTO memes_fts(memes_fts, rowid, tags) VALUES ('delete', old.id, old.tags);
+            END;
+            CREATE TRIGGER IF NOT EXISTS memes_au AFTER UPDATE OF tags ON memes BEGIN
+                INSERT INTO memes_fts(memes_fts, rowid, tags) VALUES ('delete', old.id, old.tags);
+                INSERT INTO memes_fts(rowid, tags) VALUES (new.id, new.tags);
+            END;
+        """)
+        if not fts_exists:
+            # Index memes stored before the FTS table existed
+            c.execute("INSERT INTO memes_fts(memes_fts) VALUES ('rebuild');")
+            conn.commit()
+
     except sqlite3.Error as e:
         print(e)
 
 
 def insert_meme(conn, meme_data):
     """
-    Create a new meme into the memes table
+    Create a new meme into the memes table.
+    The caller owns the transaction (e.g. ``with conn:``).
     :param conn:
-    :param meme_data: A tuple containing (content_hash, file_path, tags)
+    :param meme_data: A tuple containing
+        (content_hash, file_path, tags, width, height, telegram_unique_id)
     :return: meme id
     """
-    sql = ''' INSERT INTO memes(content_hash, file_path, tags)
-              VALUES(?,?,?) '''
-    cur = conn.cursor()
-    cur.execute(sql, meme_data)
-    conn.commit()
+    cur = conn.execute(INSERT_MEME_SQL, meme_data)
     return cur.lastrowid
 
 
-def get_all_memes(conn):
+def insert_memes_bulk(conn, rows):
     """
-    Query all memes
+    Insert many memes in a single transaction, skipping already stored content hashes
     :param conn: the Connection object
-    :return:
+    :param rows: An iterable of
+        (content_hash, file_path, tags, width, height, telegram_unique_id) tuples
+    :return: number of inserted rows
+    """
+    with conn:
+        cur = conn.executemany(INSERT_MEME_IF_NEW_SQL, rows)
+    return cur.rowcount
+
+
+def iter_memes(conn, chunk_size=100):
+    """
+    Lazily iterate over all memes, fetching chunk_size rows at a time
+    :param conn: the Connection object
+    :param chunk_size: number of rows fetched per round-trip
+    :return: A generator of (id, file_path, tags, content_hash) tuples
+    """
+    cur = conn.execute("SELECT id, file_path, tags, content_hash FROM memes")
+    while rows := cur.fetchmany(chunk_size):
+        yield from rows
+
+
+def get_recent_memes(conn, limit=50):
+    """
+    Query the most recently added memes
+    :param conn: the Connection object
+    :param limit: maximum number of rows to return
+    :return: A list of (id, file_path, width, height) tuples, newest first
+    """
+    return conn.execute(
+        "SELECT id, file_path, width, height FROM memes ORDER BY id DESC LIMIT ?", (limit,)
+    ).fetchall()
+
+
+def find_memes_by_tags(conn, tags, limit=50):
+    """
+    Query memes tagged with all of the given tags, using the FTS index
+    :param conn: the Connection object
+    :param tags: An iterable of tags that must all be present
+    :param limit: maximum number of rows to return
+    :return: A list of (id, file_path, width, height) tuples, newest first
+    """
+    # Every tag becomes an FTS phrase of its letter/digit runs; space-separated phrases are ANDed.
+    # Raw user text (quotes, NUL bytes, ...) never reaches the MATCH parser.
+    phrases = [" ".join(_FTS_TOKEN_RE.findall(tag)) for tag in tags]
+    if not all(phrases):
+        # A tag without a single letter or digit can't match anything
+        return []
+    match = " ".join(f'"{phrase}"' for phrase in phrases)
+    return conn.execute("""
+        SELECT m.id, m.file_path, m.width, m.height
+        FROM memes_fts f JOIN memes m ON m.id = f.rowid
+        WHERE memes_fts MATCH ?
+        ORDER BY m.id DESC
+        LIMIT ?
+    """, (match, limit)).fetchall()
+
+
+def get_memes_without_size(conn):
+    """
+    Query memes whose image dimensions are not stored yet.
+    Memes whose file couldn't be read are stored as 0x0 and are not returned.
+    :param conn: the Connection object
+    :return: A list of (id, file_path) tuples
+    """
+    return conn.execute("SELECT id, file_path FROM memes WHERE width IS NULL OR height IS NULL").fetchall()
+
+
+def update_meme_sizes(conn, sizes):
+    """
+    Store image dimensions for existing memes in a single transaction
+    :param conn: the Connection object
+    :param sizes: An iterable of (width, height, id) tuples
+    """
+    with conn:
+        conn.executemany("UPDATE memes SET width = ?, height = ? WHERE id = ?", sizes)
+
+
+def get_all_file_paths(conn):
+    """
+    Query the file names of all memes
+    :param conn: the Connection object
+    :return: A set of all file_path values
+    """
+    cur = conn.execute("SELECT file_path FROM memes")
+    return {row[0] for row in cur}
+
+
+def telegram_unique_id_exists(conn, telegram_unique_id):
+    """
+    Check whether a photo with the given Telegram file_unique_id is stored
+    :param conn: the Connection object
+    :param telegram_unique_id: the photo's file_unique_id
+    :return: True if a meme with this id exists
     """
-    cur = conn.cursor()
-    cur.execute("SELECT id, file_path, tags, content_hash FROM memes")
-    rows = cur.fetchall()
-    return rows
+    cur = conn.execute("SELECT 1 FROM memes WHERE telegram_unique_id = ? LIMIT 1", (telegram_unique_id,))
+    return cur.fetchone() is not None
 
 
 def get_all_hashes(conn):
@@ -81,10 +257,8 @@ def get_all_hashes(conn):
     :param conn: the Connection object
     :return: A set of all content_hash values
     """
-    cur = conn.cursor()
-    cur.execute("SELECT content_hash FROM memes WHERE content_hash IS NOT NULL")
-    rows = cur.fetchall()
-    return {row[0] for row in rows}
+    cur = conn.execute("SELECT content_hash FROM memes WHERE content_hash IS NOT NULL")
+    return {row[0] for row in cur}
 
 
 def clear_database(conn):
@@ -93,8 +267,7 @@ def clear_database(conn):
     :param conn: the Connection object
     :return:
     """
-    cur = conn.cursor()
-    cur.execute("DELETE FROM memes")
-    conn.commit()
+    with conn:
+        conn.execute("DELETE FROM memes")
 
 
@@ -2,14 +2,19 @@ import logging
 import os
 import sys
 import asyncio
+import concurrent.futures
+import multiprocessing
 import uvicorn
 import sqlite3
 import hashlib
-import tempfile
-import shutil
-from fastapi import FastAPI, HTTPException
-from starlette.responses import FileResponse
-from itsdangerous import URLSafeTimedSerializer, SignatureExpired, BadTimeSignature
+import mmap
+import re
+import io
+import stat
+import urllib.parse
+from fastapi import FastAPI, HTTPException, Request
+from starlette.responses import FileResponse, Response
+from itsdangerous import URLSafeTimedSerializer, BadSignature
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup, InlineQueryResultPhoto, Update
 from telegram.ext import (
     Application,
@@ -21,7 +26,9 @@ from telegram.ext import (
     CallbackQueryHandler,
 )
 import database as db
+import thumbnails
 from PIL import Image
+import imagesize
 import time
 import functools
 
@@ -32,40 +39,130 @@ if not URL_SIGNING_SECRET:
     sys.exit(1)
 
 signer = URLSafeTimedSerializer(URL_SIGNING_SECRET)
+# Signed URLs expire after TOKEN_MAX_AGE; a token is reused for TOKEN_REUSE_WINDOW,
+# so every URL handed out stays valid for at least the remaining half hour
+TOKEN_MAX_AGE = 3600
+TOKEN_REUSE_WINDOW = 1800
 MEME_DIR = "/app/data/memes"
 THUMBNAIL_DIR = "/app/data/thumbnails"
+TELEGRAM_MESSAGE_LIMIT = 4096
+# Read size for hashing files on Pythons without hashlib.file_digest
+HASH_CHUNK_SIZE = 1 << 20
+# Files larger than this are hashed straight from a read-only memory map
+MMAP_HASH_THRESHOLD = 1 << 20
+# Caption words of 3+ letters/digits become tags
+_TAG_RE = re.compile(r"[^\W_]{3,}")
+# Stored as a meme's dimensions when its file can't be read, so it isn't probed again
+UNREADABLE_IMAGE_SIZE = (0, 0)
+# Bulk thumbnail rendering is CPU-bound, so it runs in worker processes (one per core).
+# Workers come from a fork server rather than forking the multithreaded bot process;
+# the server preloads only the thumbnails module, so workers start with Pillow warm.
+THUMBNAIL_MP_CONTEXT = multiprocessing.get_context("forkserver")
+THUMBNAIL_MP_CONTEXT.set_forkserver_preload(["thumbnails"])
+
+# Inline query results keyed by normalized query: {key: (created_at, results)}
+QUERY_CACHE_TTL = 30
+QUERY_CACHE_MAX_ENTRIES = 256
+# How long Telegram itself may cache an answer to an inline query, in seconds.
+# Answers are sent with is_personal=True so the cache is per user and never
+# hands an allowed user's results (and signed URLs) to anyone else.
+INLINE_CACHE_TIME = 300
+_query_cache = {}
+# save_photo runs without blocking other updates; at most this many ingest at once
+INGEST_SEMAPHORE = asyncio.Semaphore(2)
+
+# When the app runs behind nginx, hand file delivery back to it via X-Accel-Redirect
+# (e.g. "/protected" with an internal location aliasing /app/data)
+X_ACCEL_REDIRECT_PREFIX = os.environ.get("X_ACCEL_REDIRECT_PREFIX", "").rstrip("/")
 
 
 # --- FastAPI App Setup ---
 web_app = FastAPI()
 
-def _get_secure_file_path(token: str, base_dir: str):
-    """Validates a signed token and returns a secure file path."""
+# Absolute roots of the served directories, resolved once
+MEME_ROOT = os.path.abspath(MEME_DIR)
+THUMBNAIL_ROOT = os.path.abspath(THUMBNAIL_DIR)
+
+@functools.lru_cache(maxsize=4096)
+def _load_token(token: str):
+    """Verifies a token's signature once; returns (filename, signed_at) or None if it is invalid.
+    Expiry is checked by the caller, since it depends on the current time."""
     try:
-        # Validate token, max_age is 1 hour (3600 seconds)
-        filename = signer.loads(token, max_age=3600)
-    except (SignatureExpired, BadTimeSignature):
+        return signer.loads(token, return_timestamp=True)
+    except BadSignature:
+        return None
+
+def _get_secure_file_path(token: str, base_dir: str):
+    """Validates a signed token and returns a secure file path, its stat result and
+    the number of seconds the token stays valid."""
+    loaded = _load_token(token)
+    # Validate token, max_age is 1 hour (3600 seconds)
+    token_age = time.time() - loaded[1].timestamp() if loaded is not None else None
+    if token_age is None or token_age > TOKEN_MAX_AGE:
         raise HTTPException(status_code=403, detail="Invalid or expired token")
 
-    # Path traversal check
-    full_path = os.path.abspath(os.path.join(base_dir, filename))
-    if not full_path.startswith(os.path.abspath(base_dir)):
+    # Path traversal check; base_dir is already absolute
+    full_path = os.path.normpath(os.path.join(base_dir, loaded[0]))
+    if not full_path.startswith(base_dir + os.sep):
         raise HTTPException(status_code=403, detail="Path traversal attempt detected")
         
-    if not os.path.exists(full_path) or not os.path.isfile(full_path):
+    # One stat per request, reused by FileResponse for its headers: files can be replaced
+    # (legacy names, files added for /rescan), so the result must not outlive the request
+    try:
+        stat_result = os.stat(full_path)
+    except OSError:
+        stat_result = None
+    if stat_result is None or not stat.S_ISREG(stat_result.st_mode):
         raise HTTPException(status_code=404, detail="File not found")
 
-    return full_path
+    return full_path, stat_result, max(0, int(TOKEN_MAX_AGE - token_age))
+
+def _file_response(request: Request, file_path: str, stat_result, max_age: int, base_dir: str, location: str):
+    """Serves a validated file, letting the reverse proxy send it when configured."""
+    # Tokens are reused for up to TOKEN_REUSE_WINDOW, so caches may only keep the
+    # response for what is left of this token's lifetime, not a full TOKEN_MAX_AGE
+    cache_control = f"public, max-age={max_age}"
+
+    if X_ACCEL_REDIRECT_PREFIX:
+        # nginx keeps only Cache-Control (among a few others) from this response and sends
+        # its own ETag for the file, so conditional requests are left to nginx entirely
+        # Rescanned files can have arbitrary names: percent-encode them for nginx's internal URI
+        relative_path = urllib.parse.quote(os.path.relpath(file_path, base_dir))
+        return Response(
+            media_type="image/jpeg",
+            headers={
+                "X-Accel-Redirect": f"{X_ACCEL_REDIRECT_PREFIX}/{location}/{relative_path}",
+                "Cache-Control": cache_control,
+            },
+        )
+
+    # Name plus mtime and size: changes whenever the file is replaced, at no extra syscall.
+    # The name is percent-encoded so quotes or non-Latin-1 characters can't break the header.
+    name = urllib.parse.quote(os.path.basename(file_path))
+    etag = f'"{name}-{stat_result.st_mtime_ns:x}-{stat_result.st_size:x}"'
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match and (
+        if_none_match.strip() == "*"
+        or etag in (tag.strip().removeprefix("W/") for tag in if_none_match.split(","))
+    ):
+        return Response(status_code=304, headers={"ETag": etag, "Cache-Control": cache_control})
+
+    return FileResponse(
+        file_path,
+        media_type="image/jpeg",
+        stat_result=stat_result,
+        headers={"ETag": etag, "Cache-Control": cache_control},
+    )
 
 @web_app.get("/memes/{token:path}")
-async def serve_meme(token: str):
-    file_path = _get_secure_file_path(token, MEME_DIR)
-    return FileResponse(file_path, media_type="image/jpeg")
+async def serve_meme(token: str, request: Request):
+    file_path, stat_result, max_age = _get_secure_file_path(token, MEME_ROOT)
+    return _file_response(request, file_path, stat_result, max_age, MEME_ROOT, "memes")
 
 @web_app.get("/thumbnails/{token:path}")
-async def serve_thumbnail(token: str):
-    file_path = _get_secure_file_path(token, THUMBNAIL_DIR)
-    return FileResponse(file_path, media_type="image/jpeg")
+async def serve_thumbnail(token: str, request: Request):
+    file_path, stat_result, max_age = _get_secure_file_path(token, THUMBNAIL_ROOT)
+    return _file_response(request, file_path, stat_result, max_age, THUMBNAIL_ROOT, "thumbnails")
 
 # Health check endpoint
 @web_app.get("/")
@@ -81,23 +178,23 @@ logger = logging.getLogger(__name__)
 # Load allowed Telegram IDs
 ALLOWED_TELEGRAM_IDS_STR = os.environ.get("ALLOWED_TELEGRAM_IDS")
 if ALLOWED_TELEGRAM_IDS_STR:
-    ALLOWED_TELEGRAM_IDS = {int(uid.strip()) for uid in ALLOWED_TELEGRAM_IDS_STR.split(',')}
-    logger.info(f"Bot will only respond to Telegram IDs: {ALLOWED_TELEGRAM_IDS}")
+    ALLOWED_TELEGRAM_IDS = frozenset(int(uid.strip()) for uid in ALLOWED_TELEGRAM_IDS_STR.split(','))
+    logger.info("Bot will only respond to Telegram IDs: %s", ALLOWED_TELEGRAM_IDS)
 else:
     ALLOWED_TELEGRAM_IDS = None
     logger.warning("No ALLOWED_TELEGRAM_IDS found in environment variables. Bot will respond to ALL users.")
 
 
 def restricted(func):
-    """Decorator to restrict access to certain Telegram user IDs."""
+    """Decorator to restrict inline and callback queries to certain Telegram user IDs.
+    Message and command handlers are restricted with a filters.User filter in main() instead.
+    """
     @functools.wraps(func)
     async def wrapped(update: Update, context, *args, **kwargs):
-        user_id = update.effective_user.id
-        if ALLOWED_TELEGRAM_IDS and user_id not in ALLOWED_TELEGRAM_IDS:
-            logger.warning(f"Unauthorized access denied for user {user_id}. Function: {func.__name__}")
-            if update.message:
-                await update.message.reply_text("You are not authorized to use this bot.")
-            elif update.inline_query:
+        user = update.effective_user
+        if ALLOWED_TELEGRAM_IDS and (user is None or user.id not in ALLOWED_TELEGRAM_IDS):
+            logger.warning("Unauthorized access denied for user %s. Function: %s", user and user.id, func.__name__)
+            if update.inline_query:
                 await update.inline_query.answer([], cache_time=1)
             elif update.callback_query:
                 await update.callback_query.answer("You are not authorized to use this bot.", show_alert=True)
@@ -106,16 +203,106 @@ def restricted(func):
     return wrapped
 
 
+async def deny(update: Update, context) -> None:
+    """Replies to messages from users outside ALLOWED_TELEGRAM_IDS."""
+    user = update.effective_user
+    logger.warning("Unauthorized access denied for user %s.", user and user.id)
+    await update.effective_message.reply_text("You are not authorized to use this bot.")
+
+
+async def _calculate_hashes(paths):
+    """Hashes many files concurrently in worker threads; hashlib releases the GIL while hashing.
+    :return: a list with the hex digest or the raised exception for every path, in order
+    """
+    return await asyncio.gather(
+        *(asyncio.to_thread(_calculate_hash, path) for path in paths), return_exceptions=True
+    )
+
+
+@functools.lru_cache(maxsize=4096)
+def _sign_in_window(filename, window):
+    """Signs filename once per reuse window; window is only part of the cache key."""
+    return signer.dumps(filename)
+
+
+def _sign(filename):
+    """Returns a signed URL token for filename, reusing it within TOKEN_REUSE_WINDOW."""
+    return _sign_in_window(filename, int(time.time()) // TOKEN_REUSE_WINDOW)
+
+
+def _invalidate_query_cache():
+    """Drops cached inline results after the meme library changes."""
+    _query_cache.clear()
+
+
+def _read_image_size(source):
+    """Returns (width, height) of an image path or file object, or UNREADABLE_IMAGE_SIZE
+    if it can't be opened. Blocking."""
+    try:
+        # Only parses the header (e.g. the JPEG SOF marker); returns (-1, -1) for unknown formats
+        width, height = imagesize.get(source)
+        if width > 0 and height > 0:
+            return width, height
+    except Exception:
+        pass
+
+    try:
+        if hasattr(source, "seek"):
+            source.seek(0)
+        with Image.open(source) as img:
+            return img.size
+    except Exception as e:
+        logger.error("Could not open image %s to get dimensions: %s", source, e)
+        return UNREADABLE_IMAGE_SIZE
+
+
+def _read_image_sizes(paths):
+    """Returns _read_image_size() for every path. Blocking; run it off the event loop."""
+    return [_read_image_size(path) for path in paths]
+
+
+def _list_files(directory):
+    """Returns the names of regular, non-hidden files in directory, using scandir's cached entry types."""
+    with os.scandir(directory) as it:
+        return {entry.name for entry in it if not entry.name.startswith(".") and entry.is_file()}
+
+
 def _calculate_hash(file_path):
     """Calculates the SHA256 hash of a file."""
-    sha256_hash = hashlib.sha256()
     with open(file_path, "rb") as f:
-        for byte_block in iter(lambda: f.read(4096), b""):
+        if os.fstat(f.fileno()).st_size > MMAP_HASH_THRESHOLD:
+            # One update over the mapped pages: no read() copies, kernel read-ahead does the I/O
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                return hashlib.sha256(mapped).hexdigest()
+        if hasattr(hashlib, "file_digest"):
+            # Python 3.11+: the read/update loop runs in C with the GIL released
+            return hashlib.file_digest(f, "sha256").hexdigest()
+        sha256_hash = hashlib.sha256()
+        for byte_block in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
             sha256_hash.update(byte_block)
-    return sha256_hash.hexdigest()
+        return sha256_hash.hexdigest()
+
+
+async def _make_thumbnails(jobs):
+    """Renders (src, dst) thumbnail jobs in a process pool created for this batch.
+    A worker that dies (e.g. OOM on a huge image) only fails this batch; the next
+    command starts with a fresh pool instead of a permanently broken one.
+    :return: a list with None or the raised exception for every job, in order
+    """
+    if not jobs:
+        return []
+    loop = asyncio.get_running_loop()
+    pool = concurrent.futures.ProcessPoolExecutor(
+        max_workers=min(len(jobs), os.cpu_count() or 1), mp_context=THUMBNAIL_MP_CONTEXT
+    )
+    try:
+        futures = [loop.run_in_executor(pool, thumbnails.make_thumbnail, src, dst) for src, dst in jobs]
+        return await asyncio.gather(*futures, return_exceptions=True)
+    finally:
+        # Joining the workers blocks: keep it off the event loop
+        await asyncio.to_thread(pool.shutdown)
 
 
-@restricted
 async def start(update: Update, context) -> None:
     """Sends a message when the command /start is issued."""
     await update.message.reply_text("Hi! I'm your personal meme storage bot. "
@@ -123,46 +310,60 @@ async def start(update: Update, context) -> None:
                                     "You can also use inline mode to search for your memes by tags.")
 
 
-@restricted
 async def save_photo(update: Update, context) -> None:
     """Saves the photo and tags, checking for duplicates using a content hash."""
     photo_obj = update.message.photo[-1]
-    file = await context.bot.get_file(photo_obj.file_id)
-    file_name = f"{photo_obj.file_id}.jpg"
-    
-    conn = db.create_connection()
-    if conn is None:
-        await update.message.reply_text("Error connecting to the database.")
+    conn = context.bot_data["db"]
+    known_hashes = context.bot_data["known_hashes"]
+
+    # Telegram re-uploads of a stored photo keep their file_unique_id: skip download and hashing
+    if db.telegram_unique_id_exists(conn, photo_obj.file_unique_id):
+        logger.info("Duplicate meme received with file_unique_id: %s", photo_obj.file_unique_id)
+        await update.message.reply_text("This meme is already saved.")
         return
 
-    try:
-        with tempfile.NamedTemporaryFile(delete=False) as temp_file:
-            await file.download_to_drive(temp_file.name)
-            content_hash = _calculate_hash(temp_file.name)
+    # Bound how many photos are downloaded and processed at once (RAM, CPU)
+    async with INGEST_SEMAPHORE:
+        file = await context.bot.get_file(photo_obj.file_id)
+
+        # Telegram photos are small: download once into memory, hash that buffer and
+        # write it out directly instead of going through a temp file
+        buffer = io.BytesIO()
+        await file.download_to_memory(buffer)
+        data = buffer.getbuffer()
+        content_hash = (await asyncio.to_thread(hashlib.sha256, data)).hexdigest()
 
+        if content_hash in known_hashes:
+            logger.info("Duplicate meme received with content_hash: %s", content_hash)
+            await update.message.reply_text("This meme is already saved.")
+            return
+
+        width, height = await asyncio.to_thread(_read_image_size, io.BytesIO(data))
+
+        # Content-addressed storage: the same image always maps to the same file name
+        file_name = f"{content_hash}.jpg"
         photo_path = os.path.join(MEME_DIR, file_name)
         thumbnail_path = os.path.join(THUMBNAIL_DIR, file_name)
-        
-        tags = set()
+    
         manual_input = update.message.caption if update.message.caption else ""
-        if manual_input:
-            for word in manual_input.split():
-                clean_word = ''.join(filter(str.isalnum, word)).lower()
-                if len(clean_word) > 2:
-                    tags.add(clean_word)
-        
+        tags = set(_TAG_RE.findall(manual_input.lower()))
+    
         try:
-            db.insert_meme(conn, (content_hash, file_name, ','.join(tags)))
-            shutil.move(temp_file.name, photo_path)
-            
-            logger.info(f"Creating thumbnail for {photo_path}")
+            with conn:
+                db.insert_meme(
+                    conn, (content_hash, file_name, ','.join(tags), width, height, photo_obj.file_unique_id)
+                )
+            known_hashes.add(content_hash)
+            _invalidate_query_cache()
+            await asyncio.to_thread(thumbnails.write_file, photo_path, data)
+        
+            logger.info("Creating thumbnail for %s", photo_path)
             try:
-                with Image.open(photo_path) as img:
-                    img.thumbnail((320, 240))
-                    img.save(thumbnail_path, "JPEG")
-                logger.info(f"Successfully created thumbnail: {thumbnail_path}")
+                # Decode the downloaded bytes still in memory rather than reading the file back
+                await asyncio.to_thread(thumbnails.make_thumbnail, io.BytesIO(data), thumbnail_path)
+                logger.info("Successfully created thumbnail: %s", thumbnail_path)
             except Exception as e:
-                logger.error(f"Could not create thumbnail for {photo_path}: {e}")
+                logger.error("Could not create thumbnail for %s: %s", photo_path, e)
 
             if tags:
                 await update.message.reply_text(f"Meme saved with tags: {', '.join(tags)}")
@@ -170,64 +371,59 @@ async def save_photo(update: Update, context) -> None:
                 await update.message.reply_text("Meme saved. Add a caption to save with tags.")
 
         except sqlite3.IntegrityError:
-            logger.info(f"Duplicate meme received with content_hash: {content_hash}")
+            logger.info("Duplicate meme received with content_hash: %s", content_hash)
             await update.message.reply_text("This meme is already saved.")
-            os.remove(temp_file.name)
 
-    finally:
-        if conn:
-            conn.close()
 
 @restricted
 async def inline_query(update: Update, context) -> None:
     """Handle the inline query."""
     query = update.inline_query.query.lower()
-    
-    conn = db.create_connection()
-    if conn is None: return
-    
-    all_memes = db.get_all_memes(conn)
-    conn.close()
+    search_tags = set(query.split())
+    cache_key = " ".join(sorted(search_tags))
 
-    results = []
-    if query:
-        search_tags = {tag.strip() for tag in query.split() if len(tag.strip()) > 0}
-        for meme in all_memes:
-            meme_tags = {t.strip() for t in meme[2].split(',') if t.strip()}
-            if search_tags.issubset(meme_tags):
-                results.append(meme)
-    else:
-        results = all_memes
+    cached = _query_cache.get(cache_key)
+    if cached and time.time() - cached[0] < QUERY_CACHE_TTL:
+        await update.inline_query.answer(cached[1], cache_time=INLINE_CACHE_TIME, is_personal=True)
+        return
 
-    results.sort(key=lambda x: x[0], reverse=True)
-    results = results[:50]
+    conn = context.bot_data["db"]
+    if search_tags:
+        results = db.find_memes_by_tags(conn, search_tags, limit=50)
+    else:
+        results = db.get_recent_memes(conn, limit=50)
 
     inline_results = []
     public_url = os.environ.get("PUBLIC_URL")
     if public_url and not public_url.startswith("http"):
         public_url = f"https://{public_url}"
     
+    # Memes stored before dimensions were recorded are probed once and the result stored,
+    # unreadable files included (as UNREADABLE_IMAGE_SIZE), so no file is probed twice
+    unsized = [result for result in results if result[2] is None or result[3] is None]
+    probed_sizes = {}
+    if unsized:
+        sizes = await asyncio.to_thread(
+            _read_image_sizes, [os.path.join(MEME_DIR, result[1]) for result in unsized]
+        )
+        probed_sizes = {result[0]: size for result, size in zip(unsized, sizes)}
+        db.update_meme_sizes(conn, [(width, height, meme_id) for meme_id, (width, height) in probed_sizes.items()])
+
     for result in results:
+        width, height = probed_sizes[result[0]] if result[0] in probed_sizes else result[2:4]
+        if not width or not height:
+            # Unreadable image: Telegram couldn't display it anyway
+            continue
         filename = result[1]
-        photo_token = signer.dumps(filename)
-        thumb_token = signer.dumps(filename) # Can use the same token
-        
-        photo_url = f"{public_url}/memes/{photo_token}"
-        thumbnail_url = f"{public_url}/thumbnails/{thumb_token}"
-        photo_path = os.path.join(MEME_DIR, filename)
+        token = _sign(filename)  # The same token is valid for both the meme and its thumbnail
 
-        width, height = 0, 0
-        try:
-            with Image.open(photo_path) as img:
-                width, height = img.size
-        except Exception as e:
-            logger.error(f"Could not open image {photo_path} to get dimensions: {e}")
-            continue
+        photo_url = f"{public_url}/memes/{token}"
+        thumbnail_url = f"{public_url}/thumbnails/{token}"
 
         try:
             inline_results.append(
                 InlineQueryResultPhoto(
-                    id=f"{result[0]}_{time.time()}",
+                    id=str(result[0]),
                     photo_url=photo_url,
                     thumbnail_url=thumbnail_url,
                     photo_width=width,
@@ -235,33 +431,43 @@ async def inline_query(update: Update, context) -> None:
                 )
             )
         except Exception as e:
-            logger.error(f"Error creating inline result for meme {filename}: {e}")
+            logger.error("Error creating inline result for meme %s: %s", filename, e)
 
-    logger.info(f"Inline results being sent: {len(inline_results)} items")
-    await update.inline_query.answer(inline_results, cache_time=1)
+    if len(_query_cache) >= QUERY_CACHE_MAX_ENTRIES:
+        _query_cache.clear()
+    _query_cache[cache_key] = (time.time(), inline_results)
+
+    logger.info("Inline results being sent: %s items", len(inline_results))
+    await update.inline_query.answer(inline_results, cache_time=INLINE_CACHE_TIME, is_personal=True)
 
 
-@restricted
 async def dump(update: Update, context) -> None:
     """Dumps the database content to the chat."""
-    conn = db.create_connection()
-    if conn is None: return
-    
-    memes = db.get_all_memes(conn)
-    conn.close()
-    
-    message = "Database content:\n"
-    for meme in memes:
-        message += f"ID: {meme[0]}, Path: {meme[1]}, Tags: {meme[2]}, Hash: {meme[3]}\n"
-    
-    for i in range(0, len(message), 4096):
-        await update.message.reply_text(message[i:i + 4096])
+    parts = ["Database content:\n"]
+    size = len(parts[0])
+
+    async def flush():
+        message = "".join(parts)
+        for i in range(0, len(message), TELEGRAM_MESSAGE_LIMIT):
+            await update.message.reply_text(message[i:i + TELEGRAM_MESSAGE_LIMIT])
+
+    # Send a message whenever the next line would not fit, instead of building the whole dump
+    for meme in db.iter_memes(context.bot_data["db"]):
+        line = f"ID: {meme[0]}, Path: {meme[1]}, Tags: {meme[2]}, Hash: {meme[3]}\n"
+        if size + len(line) > TELEGRAM_MESSAGE_LIMIT:
+            await flush()
+            parts.clear()
+            size = 0
+        parts.append(line)
+        size += len(line)
+
+    if parts:
+        await flush()
 
 
 # States for conversation
 CONFIRM_CLEAR, CANCEL_CLEAR = range(2)
 
-@restricted
 async def clear(update: Update, context) -> int:
     """Asks for confirmation to clear the database."""
     keyboard = [[InlineKeyboardButton("Yes, clear it", callback_data=str(CONFIRM_CLEAR)),
@@ -278,129 +484,152 @@ async def clear_confirmation(update: Update, context) -> int:
     await query.answer()
     
     if query.data == str(CONFIRM_CLEAR):
-        conn = db.create_connection()
-        if conn:
-            db.clear_database(conn)
-            conn.close()
-            await query.edit_message_text(text="Database cleared.")
-        else:
-            await query.edit_message_text(text="Error connecting to the database.")
+        db.clear_database(context.bot_data["db"])
+        context.bot_data["known_hashes"].clear()
+        _invalidate_query_cache()
+        await query.edit_message_text(text="Database cleared.")
     else:
         await query.edit_message_text(text="Operation cancelled.")
     return ConversationHandler.END
 
 
-@restricted
 async def regenerate_thumbnails(update: Update, context) -> None:
     """Generates thumbnails for all existing memes that don't have one."""
     await update.message.reply_text("Starting thumbnail regeneration...")
+    file_names = db.get_all_file_paths(context.bot_data["db"])
+    existing_memes = await asyncio.to_thread(_list_files, MEME_DIR)
+    existing_thumbs = await asyncio.to_thread(_list_files, THUMBNAIL_DIR)
     
-    conn = db.create_connection()
-    if conn is None:
-        await update.message.reply_text("Error connecting to the database.")
-        return
-        
-    memes = db.get_all_memes(conn)
-    conn.close()
-    
-    generated_count = 0
     skipped_count = 0
+    jobs = []
     
-    for meme in memes:
-        file_name = meme[1]
+    for file_name in file_names:
         photo_path = os.path.join(MEME_DIR, file_name)
         thumbnail_path = os.path.join(THUMBNAIL_DIR, file_name)
 
-        if not os.path.exists(photo_path):
-            logger.warning(f"Source meme image not found: {photo_path}")
+        if file_name not in existing_memes:
+            logger.warning("Source meme image not found: %s", photo_path)
             continue
         
-        if os.path.exists(thumbnail_path):
+        if file_name in existing_thumbs:
             skipped_count += 1
             continue
-            
-        try:
-            with Image.open(photo_path) as img:
-                img.thumbnail((320, 240))
-                img.save(thumbnail_path, "JPEG")
+
+        jobs.append((photo_path, thumbnail_path))
+
+    generated_count = 0
+    for (photo_path, thumbnail_path), error in zip(jobs, await _make_thumbnails(jobs)):
+        if error:
+            logger.error("Could not create thumbnail for %s: %s", photo_path, error)
+        else:
             generated_count += 1
-            logger.info(f"Generated thumbnail for {file_name}")
-        except Exception as e:
-            logger.error(f"Could not create thumbnail for {photo_path}: {e}")
+            logger.info("Generated thumbnail for %s", os.path.basename(photo_path))
 
     await update.message.reply_text(f"Thumbnail regeneration complete. Generated: {generated_count}, Skipped: {skipped_count}")
 
 
-@restricted
 async def rescan(update: Update, context) -> None:
     """Scans the memes folder for images not present in the database."""
     await update.message.reply_text("Starting library rescan...")
+    conn = context.bot_data["db"]
 
-    conn = db.create_connection()
-    if conn is None:
-        await update.message.reply_text("Error connecting to the database.")
-        return
+    known_hashes = context.bot_data["known_hashes"]
+    queued_hashes = set()
+    new_rows = []
+    thumb_jobs = []
     
-    try:
-        existing_hashes = db.get_all_hashes(conn)
-        added_count = 0
-        thumb_generated_count = 0
-        
-        if not os.path.isdir(MEME_DIR):
-            await update.message.reply_text(f"Error: Meme directory not found at {MEME_DIR}")
-            return
+    if not os.path.isdir(MEME_DIR):
+        await update.message.reply_text(f"Error: Meme directory not found at {MEME_DIR}")
+        return
 
-        for filename in os.listdir(MEME_DIR):
-            file_path = os.path.join(MEME_DIR, filename)
-            if not os.path.isfile(file_path):
-                continue
-            
-            content_hash = _calculate_hash(file_path)
-            
-            if content_hash not in existing_hashes:
-                try:
-                    db.insert_meme(conn, (content_hash, filename, ""))
-                    added_count += 1
-                    logger.info(f"Added new meme from scan: {filename}")
-                except sqlite3.IntegrityError:
-                    logger.warning(f"Meme from scan was already in DB (race condition): {filename}")
-                    continue
-            
-            thumbnail_path = os.path.join(THUMBNAIL_DIR, filename)
-            if not os.path.exists(thumbnail_path):
-                try:
-                    with Image.open(file_path) as img:
-                        img.thumbnail((320, 240))
-                        img.save(thumbnail_path, "JPEG")
-                    thumb_generated_count += 1
-                    logger.info(f"Generated missing thumbnail for {filename}")
-                except Exception as e:
-                    logger.error(f"Could not create thumbnail for {file_path}: {e}")
-
-        await update.message.reply_text(f"Rescan complete. Added: {added_count} new memes. Generated: {thumb_generated_count} missing thumbnails.")
+    stored_files = db.get_all_file_paths(conn)
+    existing_thumbs = await asyncio.to_thread(_list_files, THUMBNAIL_DIR)
+    file_names = sorted(await asyncio.to_thread(_list_files, MEME_DIR))
 
-    finally:
-        if conn:
-            conn.close()
+    for filename in file_names:
+        if filename not in existing_thumbs:
+            thumb_jobs.append((os.path.join(MEME_DIR, filename), os.path.join(THUMBNAIL_DIR, filename)))
+
+    # Only files not stored under their name yet can be new: hash just those
+    file_names = [filename for filename in file_names if filename not in stored_files]
+    file_paths = [os.path.join(MEME_DIR, filename) for filename in file_names]
+    content_hashes = await _calculate_hashes(file_paths)
+
+    for filename, file_path, content_hash in zip(file_names, file_paths, content_hashes):
+        if isinstance(content_hash, Exception):
+            logger.error("Could not hash %s: %s", file_path, content_hash)
+            continue
+
+        if content_hash not in known_hashes and content_hash not in queued_hashes:
+            # Track queued hashes too, so identical files on disk are added once
+            queued_hashes.add(content_hash)
+            width, height = await asyncio.to_thread(_read_image_size, file_path)
+            new_rows.append((content_hash, filename, "", width, height, None))
+            logger.info("Queued new meme from scan: %s", filename)
+
+    thumb_generated_count = 0
+    for (file_path, thumbnail_path), error in zip(thumb_jobs, await _make_thumbnails(thumb_jobs)):
+        if error:
+            logger.error("Could not create thumbnail for %s: %s", file_path, error)
+        else:
+            thumb_generated_count += 1
+            logger.info("Generated missing thumbnail for %s", os.path.basename(file_path))
+
+    added_count = 0
+    if new_rows:
+        # Rows saved concurrently by save_photo are skipped rather than failing the batch
+        added_count = db.insert_memes_bulk(conn, new_rows)
+        known_hashes.update(queued_hashes)
+        _invalidate_query_cache()
+        logger.info("Added %s new memes from scan", added_count)
+
+    # Backfill dimensions for memes stored before they were recorded
+    unsized = db.get_memes_without_size(conn)
+    sizes = await asyncio.to_thread(
+        _read_image_sizes, [os.path.join(MEME_DIR, file_name) for _, file_name in unsized]
+    )
+    backfill = [(width, height, meme_id) for (meme_id, _), (width, height) in zip(unsized, sizes)]
+    if backfill:
+        db.update_meme_sizes(conn, backfill)
+        _invalidate_query_cache()
+        logger.info("Stored dimensions for %s existing memes", len(backfill))
+
+    await update.message.reply_text(f"Rescan complete. Added: {added_count} new memes. Generated: {thumb_generated_count} missing thumbnails.")
 
 
 async def main() -> None:
     """Runs the bot and the web server concurrently."""
     application = Application.builder().token(os.environ["TELEGRAM_TOKEN"]).build()
 
+    # A single long-lived connection keeps SQLite's page cache warm across updates
+    conn = db.create_connection()
+    if conn is None:
+        logger.critical("FATAL: Could not connect to the database.")
+        sys.exit(1)
+    application.bot_data["db"] = conn
+    # Content hashes of every stored meme, for O(1) duplicate checks on upload
+    application.bot_data["known_hashes"] = db.get_all_hashes(conn)
+
+    # Let PTB drop unauthorized messages before any handler coroutine is created
+    auth = filters.User(user_id=ALLOWED_TELEGRAM_IDS) if ALLOWED_TELEGRAM_IDS else filters.ALL
+
     clear_handler = ConversationHandler(
-        entry_points=[CommandHandler("clear", clear)],
+        entry_points=[CommandHandler("clear", clear, filters=auth)],
         states={CONFIRM_CLEAR: [CallbackQueryHandler(clear_confirmation)]},
-        fallbacks=[CommandHandler("clear", clear)],
+        fallbacks=[CommandHandler("clear", clear, filters=auth)],
     )
 
-    application.add_handler(CommandHandler("start", start))
-    application.add_handler(CommandHandler("dump", dump))
-    application.add_handler(CommandHandler("regenerate_thumbnails", regenerate_thumbnails))
-    application.add_handler(CommandHandler("rescan", rescan))
+    application.add_handler(CommandHandler("start", start, filters=auth))
+    application.add_handler(CommandHandler("dump", dump, filters=auth))
+    application.add_handler(CommandHandler("regenerate_thumbnails", regenerate_thumbnails, filters=auth))
+    application.add_handler(CommandHandler("rescan", rescan, filters=auth))
     application.add_handler(clear_handler)
-    application.add_handler(MessageHandler(filters.PHOTO, save_photo))
+    application.add_handler(MessageHandler(filters.PHOTO & auth, save_photo, block=False))
     application.add_handler(InlineQueryHandler(inline_query))
+    if ALLOWED_TELEGRAM_IDS:
+        # Answer what the handlers above would have: commands and photos sent by a user
+        unauthorized = (filters.COMMAND | filters.PHOTO) & filters.UpdateType.MESSAGES & ~auth
+        application.add_handler(MessageHandler(unauthorized, deny))
     
     config = uvicorn.Config(web_app, host="0.0.0.0", port=8000, log_level="info")
     server = uvicorn.Server(config)
@@ -418,9 +647,24 @@ async def main() -> None:
         await application.stop()
         logger.info("Telegram Bot stopped.")
 
+    conn.close()
+
+
+def run() -> None:
+    """Entry point: installs uvloop when available and runs main()."""
+    try:
+        # libuv-based event loop, installed with uvicorn[standard]
+        import uvloop
+    except ImportError:
+        logger.info("uvloop not installed, using the default asyncio event loop.")
+    else:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
 
-if __name__ == "__main__":
     try:
         asyncio.run(main())
     except (KeyboardInterrupt, SystemExit):
         logger.info("Bot stopped.")
+
+
+if __name__ == "__main__":
+    run()
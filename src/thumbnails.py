@@ -0,0 +1,58 @@
+import io
+import logging
+import os
+import threading
+
+from PIL import Image
+
+try:
+    # Optional faster JPEG encoder (libjpeg-turbo) for thumbnails
+    import numpy as np
+    import simplejpeg
+except ImportError:
+    simplejpeg = None
+
+# Kept free of bot imports: thumbnail worker processes import only this module
+THUMBNAIL_SIZE = (320, 240)
+
+logger = logging.getLogger(__name__)
+
+
+def write_file(path, data):
+    """
+    Write data to path via a temporary sibling and an atomic rename. Blocking.
+    The temp file is dot-prefixed so directory scans that skip hidden files never
+    pick up a partial or leftover one; pid and thread id keep concurrent writers
+    of the same path apart.
+    :param path: destination file path
+    :param data: bytes-like object to write
+    """
+    directory, name = os.path.split(path)
+    temp_path = os.path.join(directory, f".{name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    with open(temp_path, "wb") as f:
+        f.write(data)
+    os.replace(temp_path, path)
+
+
+def make_thumbnail(src, dst):
+    """
+    Render a JPEG thumbnail of src into dst. Blocking; run it off the event loop.
+    :param src: image path or file object
+    :param dst: thumbnail path, replaced atomically
+    """
+    with Image.open(src) as img:
+        # For JPEGs, let libjpeg decode at a reduced scale (1/2 .. 1/8) close to the target size
+        img.draft("RGB", THUMBNAIL_SIZE)
+        img.thumbnail(THUMBNAIL_SIZE, Image.Resampling.BILINEAR)
+        data = None
+        if simplejpeg is not None and img.mode == "RGB":
+            try:
+                data = simplejpeg.encode_jpeg(np.asarray(img), quality=80, colorspace="RGB")
+            except Exception as e:
+                logger.debug("simplejpeg could not encode %s, falling back to Pillow: %s", dst, e)
+        if data is None:
+            buffer = io.BytesIO()
+            img.save(buffer, "JPEG", quality=80)
+            data = buffer.getbuffer()
+    # Atomic replace: the web server never sees (or stats) a half-written thumbnail
+    write_file(dst, data)